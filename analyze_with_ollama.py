@@ -4,109 +4,213 @@ analyze_with_ollama.py
 Send high-score anomalous sessions to Ollama for analysis.
 """
 
-import json
+import asyncio
+import hashlib
+import math
+import os
+import shelve
 import sys
-import subprocess
-from pathlib import Path
-from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
-import time
+
+import ollama
+import orjson
+
+# Single client for the whole run so every request reuses the same HTTP
+# connection pool. Start the server with OLLAMA_NUM_PARALLEL > 1 so that
+# concurrent requests are actually scheduled in parallel.
+OLLAMA_HOST = os.getenv("OLLAMA_HOST", "http://localhost:11434")
+client = ollama.AsyncClient(host=OLLAMA_HOST)
+
+# Sessions sent to the LLM per request, and how long the server keeps the
+# model loaded after each request so later batches never pay a reload.
+BATCH_SIZE = 16
+KEEP_ALIVE = "30m"
+
+# Batches analyzed at once; match the server's OLLAMA_NUM_PARALLEL
+MAX_IN_FLIGHT = int(os.getenv("OLLAMA_NUM_PARALLEL", "4"))
+
+# On-disk verdict cache shared across runs
+CACHE_FILE = os.getenv("LLM_CACHE_FILE", ".llm_cache")
 
 def load_scored_sessions(json_file):
     """Load scored sessions from JSON."""
-    with open(json_file, 'r') as f:
-        return json.load(f)
+    with open(json_file, 'rb') as f:
+        return orjson.loads(f.read())
+
+def log_bucket(value):
+    """Bucket a non-negative number by powers of two."""
+    return int(math.log2(float(value) + 1))
+
+def cache_key(session, model):
+    """Hash the parts of a session the verdict depends on.
+    
+    Volume and rate features are log-binned so near-identical sessions on the
+    same endpoints share one cache entry. The prompt version is included so
+    stored verdicts are invalidated whenever the prompt templates change.
+    """
+    fingerprint = orjson.dumps([
+        PROMPT_VERSION,
+        model,
+        session['src_ip'],
+        session['dst_ip'],
+        int(session['src_port']),
+        int(session['dst_port']),
+        log_bucket(session['total_bytes']),
+        log_bucket(session['packet_count']),
+        log_bucket(session['packets_per_second']),
+        round(session['anomaly_score'], 1)
+    ])
+    return hashlib.blake2b(fingerprint, digest_size=16).hexdigest()
 
-def build_analysis_prompt(session):
-    """Build prompt for LLM analysis."""
-    baseline_mean = session.get("baseline_mean", "unknown")
-    baseline_deviation = session.get("deviation_factor", "unknown")
+def is_verdict(analysis):
+    """Check whether an analysis string is a parsed per-session verdict object."""
+    try:
+        return isinstance(orjson.loads(analysis), dict)
+    except orjson.JSONDecodeError:
+        return False
 
-    prompt = f"""
-Analyze this network session and classify it.
+# Prompt templates, filled with str.format_map. The JSON braces in the
+# output format are doubled once here instead of being re-escaped per call.
+SESSION_LINE = (
+    '{{"src": "{src_ip}:{src_port}", "dst": "{dst_ip}:{dst_port}", '
+    '"bytes": {total_bytes}, "packets": {packet_count}, '
+    '"rate": {packets_per_second}, "score": {anomaly_score:.3f}}}'
+)
 
-Return ONLY valid JSON. No explanations, no commentary.
+ANALYSIS_PROMPT = """
+Analyze these {count} network sessions and classify each one.
 
-Session:
-src={session['src_ip']}:{session['src_port']}
-dst={session['dst_ip']}:{session['dst_port']}
-bytes={session['total_bytes']}
-packets={session['packet_count']}
-rate={session['packets_per_second']}
-score={session['anomaly_score']}
+Return ONLY a valid JSON array of exactly {count} verdicts, one per session, in the same order. No explanations, no commentary.
 
-Output Format (strict JSON):
-{{
-  "status": "normal" or "suspicious",
-  "reason": "short, one sentence",
-  "action": "firewall or IDS recommendation"
-}}
-""".replace("{", "{{").replace("}", "}}", 1).replace("}}", "}", 1)
+Sessions:
+[
+{sessions}
+]
+
+Output Format (strict JSON array, one object per session):
+[
+  {{
+    "status": "normal" or "suspicious",
+    "reason": "short, one sentence",
+    "action": "firewall or IDS recommendation"
+  }}
+]
+"""
+
+# Changes whenever either template is edited; part of every cache key
+PROMPT_VERSION = hashlib.blake2b(
+    (ANALYSIS_PROMPT + SESSION_LINE).encode(), digest_size=8
+).hexdigest()
+
+def build_analysis_prompt(sessions):
+    """Build one prompt asking the LLM to classify a batch of sessions."""
+    session_lines = ",\n".join(SESSION_LINE.format_map(s) for s in sessions)
+    return ANALYSIS_PROMPT.format(count=len(sessions), sessions=session_lines)
+
+def extract_json(response):
+    """Strip markdown code fences (```json ... ```) around an LLM response."""
+    if "```json" in response:
+        json_start = response.find("```json") + 7
+        json_end = response.find("```", json_start)
+        response = response[json_start:json_end].strip()
+    elif "```" in response:
+        json_start = response.find("```") + 3
+        json_end = response.find("```", json_start)
+        response = response[json_start:json_end].strip()
+    return response
+
+def split_verdicts(response, count):
+    """Split a batched LLM response into one analysis string per session.
+    
+    Returns None when a multi-session response cannot be split into exactly
+    `count` verdicts; a single-session response is returned as-is instead.
+    """
+    response = extract_json(response)
+    
+    try:
+        parsed = orjson.loads(response)
+    except orjson.JSONDecodeError:
+        # JSON 파싱 실패시 원본 반환 (배치는 세션별 재요청)
+        return [response] if count == 1 else None
+    
+    if isinstance(parsed, dict) and count == 1:
+        parsed = [parsed]
+    
+    if not isinstance(parsed, list) or len(parsed) != count:
+        # 세션 수와 판정 수가 맞지 않으면 원본 반환 (배치는 세션별 재요청)
+        return [response] if count == 1 else None
+    
+    return [orjson.dumps(verdict).decode() for verdict in parsed]
 
-    return prompt
+async def warm_up_model(model, timeout=120):
+    """Load the model once up front and keep it resident for KEEP_ALIVE."""
+    try:
+        # 빈 프롬프트는 모델만 메모리에 올리고 바로 반환
+        await asyncio.wait_for(
+            client.generate(model=model, prompt="", keep_alive=KEEP_ALIVE),
+            timeout=timeout
+        )
+    except Exception as e:
+        print(f"    Warning: model warm-up failed ({str(e) or type(e).__name__})")
 
-def analyze_with_ollama(session, model="qwen2:1.5b", timeout=120, max_retries=2):
-    """Send session to Ollama for analysis with retry logic."""
-    prompt = build_analysis_prompt(session)
+async def analyze_with_ollama(sessions, model="qwen2:1.5b", timeout=120, max_retries=2):
+    """Send a batch of sessions to Ollama in one request, with retry logic.
+    
+    `timeout` is per session; the request deadline is timeout * len(sessions).
+    If the reply does not hold one verdict per session, each session is
+    re-sent on its own. Returns one analysis string per session, in input order.
+    """
+    prompt = build_analysis_prompt(sessions)
+    count = len(sessions)
     
     for attempt in range(max_retries):
         try:
-            # Ollama 프로세스 실행
-            result = subprocess.run(
-                ["ollama", "run", model],
-                input=prompt,
-                text=True,
-                capture_output=True,
-                timeout=timeout
+            # Ollama HTTP API 호출 (배치당 1회, 모델은 keep_alive 동안 메모리에 유지)
+            result = await asyncio.wait_for(
+                client.generate(
+                    model=model,
+                    prompt=prompt,
+                    stream=False,
+                    keep_alive=KEEP_ALIVE,
+                    options={"num_predict": 128 * count}
+                ),
+                timeout=timeout * count
             )
             
-            if result.returncode == 0:
-                response = result.stdout.strip()
-                
-                # JSON 파싱 시도
-                try:
-                    # JSON만 추출 (```json ``` 태그 제거)
-                    if "```json" in response:
-                        json_start = response.find("```json") + 7
-                        json_end = response.find("```", json_start)
-                        response = response[json_start:json_end].strip()
-                    elif "```" in response:
-                        json_start = response.find("```") + 3
-                        json_end = response.find("```", json_start)
-                        response = response[json_start:json_end].strip()
-                    
-                    # JSON 유효성 검사
-                    parsed = json.loads(response)
-                    return response
-                except json.JSONDecodeError:
-                    # JSON 파싱 실패시 원본 반환
-                    return response
+            verdicts = split_verdicts(result["response"].strip(), count)
+            if verdicts is not None:
+                return verdicts
+            
+            # 판정 수가 맞지 않으면 세션별로 순차 재요청 (동시 요청 수 유지)
+            print(f"    Batch reply did not contain {count} verdicts - retrying sessions one by one...")
+            return [(await analyze_with_ollama([s], model, timeout, max_retries))[0] for s in sessions]
+        
+        except ollama.ResponseError as e:
+            error_msg = f"Error (attempt {attempt + 1}/{max_retries}): {e.error}"
+            if attempt < max_retries - 1:
+                print(f"    {error_msg} - Retrying...")
+                await asyncio.sleep(2)
             else:
-                error_msg = f"Error (attempt {attempt + 1}/{max_retries}): {result.stderr}"
-                if attempt < max_retries - 1:
-                    print(f"    {error_msg} - Retrying...")
-                    time.sleep(2)
-                else:
-                    return error_msg
+                return [error_msg] * count
         
-        except subprocess.TimeoutExpired:
-            error_msg = f"Error: Analysis timeout after {timeout}s (attempt {attempt + 1}/{max_retries})"
+        except asyncio.TimeoutError:
+            error_msg = f"Error: Analysis timeout after {timeout * count}s (attempt {attempt + 1}/{max_retries})"
             if attempt < max_retries - 1:
                 print(f"    {error_msg} - Retrying with longer timeout...")
-                timeout += 60  # 타임아웃 증가
-                time.sleep(2)
+                timeout += 60  # 세션당 타임아웃 증가
+                await asyncio.sleep(2)
             else:
-                return error_msg
+                return [error_msg] * count
         
-        except FileNotFoundError:
-            return "Error: Ollama not found. Please install Ollama (https://ollama.ai)"
+        except ConnectionError:
+            return [f"Error: Cannot reach Ollama at {OLLAMA_HOST}. Please install and start Ollama (https://ollama.ai)"] * count
         
         except Exception as e:
-            return f"Error: {str(e)}"
+            return [f"Error: {str(e)}"] * count
     
-    return "Error: Max retries exceeded"
+    return ["Error: Max retries exceeded"] * count
 
-def main(scored_file, output_file, threshold=0.6, model="qwen2:1.5b", timeout=30):
+async def main(scored_file, output_file, threshold=0.6, model="qwen2:1.5b", timeout=30):
     """Main analysis pipeline."""
     print(f"Loading scored sessions from {scored_file}...")
     sessions = load_scored_sessions(scored_file)
@@ -115,62 +219,80 @@ def main(scored_file, output_file, threshold=0.6, model="qwen2:1.5b", timeout=30
     high_score_sessions = [s for s in sessions if s['anomaly_score'] >= threshold]
     
     print(f"Found {len(high_score_sessions)} sessions with score ≥ {threshold}")
-    print(f"Using model: {model} (timeout: {timeout}s)\n")
+    print(f"Using model: {model} (timeout: {timeout}s per session)\n")
     
     if not high_score_sessions:
         print("No sessions to analyze.")
         return
     
-    # Analyze each session
-    results = []
-    
-    def worker(session):
-        """각 세션을 LLM으로 분석"""
-        start_time = datetime.now()
-        analysis = analyze_with_ollama(session, model, timeout)
-        elapsed = (datetime.now() - start_time).total_seconds()
-        return {
-            "timestamp": datetime.now().isoformat(),
-            "session": session,
-            "llm_analysis": analysis,
-            "analysis_time_seconds": round(elapsed, 2)
-        }
-
-    # 최대 4개 세션을 동시에 분석
-    max_workers = 4
-    with ThreadPoolExecutor(max_workers=4) as executor:
-        futures = {executor.submit(worker, s): s for s in high_score_sessions}
-        for future in as_completed(futures):
-            result = future.result()
-            results.append(result)
-            session = result["session"]
-            print(f"Completed session {session['src_ip']}->{session['dst_ip']}")
-
-
+    # Analyze sessions in batches, keeping at most MAX_IN_FLIGHT requests open
+    semaphore = asyncio.Semaphore(MAX_IN_FLIGHT)
     
-    # Save final results
-    with open(output_file, 'w') as f:
-        json.dump(results, f, indent=2)
+    async def worker(batch):
+        """세션 배치를 LLM으로 분석"""
+        async with semaphore:
+            start_time = datetime.now()
+            analyses = await analyze_with_ollama(batch, model, timeout)
+            elapsed = (datetime.now() - start_time).total_seconds()
+        return [(session, analysis, elapsed) for session, analysis in zip(batch, analyses)]
     
-    # Remove temp file if exists
-    temp_file = Path(output_file + ".tmp")
-    if temp_file.exists():
-        temp_file.unlink()
+    cache_hits = 0
+    with shelve.open(CACHE_FILE) as cache, open(output_file, 'wb') as f:
+        def write_result(session, analysis, elapsed):
+            """결과를 JSONL 한 줄로 기록"""
+            f.write(orjson.dumps({
+                "timestamp": datetime.now().isoformat(),
+                "session": session,
+                "llm_analysis": analysis,
+                "analysis_time_seconds": round(elapsed, 2)
+            }))
+            f.write(b"\n")
+            print(f"Completed session {session['src_ip']}->{session['dst_ip']}")
+        
+        # 캐시에 있는 세션은 바로 기록, 나머지는 같은 지문끼리 묶어 한 번만 요청
+        pending = {}
+        for session in high_score_sessions:
+            key = cache_key(session, model)
+            if key in cache:
+                write_result(session, cache[key], 0.0)
+                cache_hits += 1
+            else:
+                pending.setdefault(key, []).append(session)
+        f.flush()
+        
+        representatives = [group[0] for group in pending.values()]
+        if representatives:
+            print(f"Loading model {model}...")
+            await warm_up_model(model, timeout)
+        
+        batches = [representatives[i:i + BATCH_SIZE]
+                   for i in range(0, len(representatives), BATCH_SIZE)]
+        tasks = [worker(b) for b in batches]
+        
+        # 완료되는 순서대로 결과를 한 줄씩 기록 (JSONL, 중단되어도 결과 보존)
+        for future in asyncio.as_completed(tasks):
+            for session, analysis, elapsed in await future:
+                key = cache_key(session, model)
+                if is_verdict(analysis):
+                    cache[key] = analysis
+                for duplicate in pending[key]:
+                    write_result(duplicate, analysis, elapsed)
+            f.flush()
     
     print(f"\n{'='*60}")
     print(f"Analysis complete!")
     print(f"Results saved to: {output_file}")
-    print(f"Total sessions analyzed: {len(results)}")
+    print(f"Total sessions analyzed: {len(high_score_sessions)} (cache hits: {cache_hits})")
     print(f"{'='*60}")
 
 if __name__ == "__main__":
     if len(sys.argv) < 3:
-        print("Usage: python analyze_with_ollama.py <scored.json> <output.json> [threshold] [model] [timeout]")
+        print("Usage: python analyze_with_ollama.py <scored.json> <output.jsonl> [threshold] [model] [timeout]")
         print("  threshold: minimum anomaly score (default: 0.6)")
         print("  model: ollama model name (default: qwen2:1.5b)")
-        print("  timeout: analysis timeout in seconds (default: 120)")
+        print("  timeout: analysis timeout per session in seconds (default: 120)")
         print("\nExample:")
-        print("  python analyze_with_ollama.py scored_sessions.json analysis_results.json 0.7 llama3 180")
+        print("  python analyze_with_ollama.py scored_sessions.json analysis_results.jsonl 0.7 llama3 180")
         sys.exit(1)
     
     scored_file = sys.argv[1]
@@ -179,4 +301,4 @@ if __name__ == "__main__":
     model = sys.argv[4] if len(sys.argv) > 4 else "qwen2:1.5b"
     timeout = int(sys.argv[5]) if len(sys.argv) > 5 else 120
     
-    main(scored_file, output_file, threshold, model, timeout)
\ No newline at end of file
+    asyncio.run(main(scored_file, output_file, threshold, model, timeout))
\ No newline at end of file
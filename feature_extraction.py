@@ -4,177 +4,225 @@ feature_extraction.py
 Converts PCAP files to session-level JSON with extracted features.
 """
 
-import json
-import subprocess
+import socket
 import sys
+import time
 from pathlib import Path
-from datetime import datetime, timedelta
-from collections import defaultdict
 import ipaddress
 
-def run_tshark(pcap_file):
-    """Convert PCAP to JSON using tshark."""
-    try:
-        result = subprocess.run(
-            ["tshark", "-r", str(pcap_file), "-T", "json"],
-            capture_output=True,
-            text=True,
-            check=True
-        )
-        return json.loads(result.stdout)
-    except subprocess.CalledProcessError as e:
-        print(f"Error running tshark: {e}", file=sys.stderr)
-        return []
-    except json.JSONDecodeError as e:
-        print(f"Error parsing tshark JSON: {e}", file=sys.stderr)
-        return []
+import dpkt
+import numpy as np
+import orjson
+import pandas as pd
 
-def extract_packet_info(packet):
-    """Extract relevant fields from a tshark packet."""
-    layers = packet.get("_source", {}).get("layers", {})
-    
-    # Frame info
-    frame = layers.get("frame", {})
-    time_epoch = frame.get("frame.time_epoch")
-    time_str = frame.get("frame.time")
-    frame_len = int(frame.get("frame.len", 0) or 0)
+# Columns that identify a session
+SESSION_KEY = ["src_ip", "dst_ip", "src_port", "dst_port"]
 
-    if time_epoch is not None:
-        try:
-            timestamp = float(time_epoch)
-        except ValueError:
-            timestamp = 0.0
-    elif time_str:
-        try:
-            dt = datetime.fromisoformat(time_str.replace("Z", "+00:00"))
-            timestamp = dt.timestamp()
-        except Exception:
-            timestamp = 0.0
-    else:
-        timestamp = 0.0
+# Link-layer decoders: raw frame -> network-layer packet
+LINK_DECODERS = {
+    dpkt.pcap.DLT_EN10MB: lambda buf: dpkt.ethernet.Ethernet(buf).data,
+    dpkt.pcap.DLT_LINUX_SLL: lambda buf: dpkt.sll.SLL(buf).data,
+    dpkt.pcap.DLT_LINUX_SLL2: lambda buf: dpkt.sll2.SLL2(buf).data,
+    dpkt.pcap.DLT_NULL: lambda buf: dpkt.loopback.Loopback(buf).data,
+    dpkt.pcap.DLT_LOOP: lambda buf: dpkt.loopback.Loopback(buf).data,
+    dpkt.pcap.DLT_RAW: dpkt.ip.IP,
+    14: dpkt.ip.IP,   # DLT_RAW on OpenBSD
+    101: dpkt.ip.IP,  # LINKTYPE_RAW
+    dpkt.pcap.DLT_IPV4: dpkt.ip.IP,
+}
+
+NO_ADDRESS = ("0.0.0.0", "0.0.0.0", "0", "0")
+
+def extract_packet_info(buf, decode_link):
+    """Extract (src_ip, dst_ip, src_port, dst_port) from a raw frame."""
+    try:
+        ip = decode_link(buf)
+    except (dpkt.UnpackError, ValueError):
+        return NO_ADDRESS
     
-    # IP layer
-    ip = layers.get("ip", {})
-    src_ip = ip.get("ip.src", "0.0.0.0")
-    dst_ip = ip.get("ip.dst", "0.0.0.0")
+    # IP layer (IPv4 only; anything else is grouped under 0.0.0.0)
+    if isinstance(ip, dpkt.ip.IP):
+        src_ip, dst_ip = socket.inet_ntoa(ip.src), socket.inet_ntoa(ip.dst)
+    else:
+        src_ip, dst_ip = "0.0.0.0", "0.0.0.0"
     
     # Transport layer
-    tcp = layers.get("tcp", {})
-    udp = layers.get("udp", {})
+    transport = getattr(ip, "data", None)
+    if isinstance(transport, (dpkt.tcp.TCP, dpkt.udp.UDP)):
+        return src_ip, dst_ip, str(transport.sport), str(transport.dport)
+    
+    return src_ip, dst_ip, "0", "0"
+
+def read_pcap(pcap_file):
+    """Read a PCAP/PCAPNG file with dpkt into a packet DataFrame."""
+    timestamps, lengths, addresses = [], [], []
     
-    src_port = tcp.get("tcp.srcport") or udp.get("udp.srcport", "0")
-    dst_port = tcp.get("tcp.dstport") or udp.get("udp.dstport", "0")
+    try:
+        with open(pcap_file, 'rb') as f:
+            reader = dpkt.pcap.UniversalReader(f)
+            decode_link = LINK_DECODERS.get(reader.datalink())
+            if decode_link is None:
+                print(f"Error: unsupported link type {reader.datalink()}", file=sys.stderr)
+                return pd.DataFrame(columns=["timestamp", "bytes"] + SESSION_KEY)
+            
+            for ts, buf in reader:
+                timestamps.append(float(ts))
+                lengths.append(len(buf))
+                addresses.append(extract_packet_info(buf, decode_link))
+    except (OSError, ValueError, dpkt.UnpackError) as e:
+        print(f"Error reading {pcap_file}: {e}", file=sys.stderr)
+    
+    packets = pd.DataFrame(addresses, columns=SESSION_KEY)
+    packets.insert(0, "timestamp", np.array(timestamps, dtype=np.float64))
+    packets.insert(1, "bytes", np.array(lengths, dtype=np.int64))
+    
+    return packets
+
+def build_sessions(packets, directional=False):
+    """Assign packets to sessions based on 5-tuple.
+    
+    Returns the packet table with SESSION_KEY columns set to the canonical
+    (bidirectional) session key of each packet. With directional=True each
+    direction is its own session and the packet's own src/dst are kept.
+    """
+    if directional:
+        return packets
+    
+    src_ip, dst_ip = packets["src_ip"], packets["dst_ip"]
+    src_port, dst_port = packets["src_port"], packets["dst_port"]
+    
+    # Create session key (bidirectional): the lexicographically smaller
+    # of the two directions
+    forward = (src_ip < dst_ip) | ((src_ip == dst_ip) & (src_port <= dst_port))
+    packets["src_ip"], packets["dst_ip"] = src_ip.where(forward, dst_ip), dst_ip.where(forward, src_ip)
+    packets["src_port"], packets["dst_port"] = src_port.where(forward, dst_port), dst_port.where(forward, src_port)
+    
+    return packets
+
+def build_destination_index(packets):
+    """Index every packet by source IP as time-sorted (timestamps, destination ids) arrays."""
+    src_ids, src_ips = pd.factorize(packets["src_ip"])
+    dst_ids, _ = pd.factorize(packets["dst_ip"])
+    timestamps = packets["timestamp"].to_numpy()
+    
+    # Sort by source, then by time, and slice out each source's run
+    order = np.lexsort((timestamps, src_ids))
+    src_ids, timestamps, dst_ids = src_ids[order], timestamps[order], dst_ids[order]
+    bounds = np.flatnonzero(np.diff(src_ids)) + 1
+    starts = np.concatenate(([0], bounds))
+    ends = np.concatenate((bounds, [len(order)]))
     
     return {
-        "timestamp": timestamp,
-        "src_ip": src_ip,
-        "dst_ip": dst_ip,
-        "src_port": str(src_port),
-        "dst_port": str(dst_port),
-        "bytes": frame_len
+        src_ips[src_ids[start]]: (timestamps[start:end], dst_ids[start:end])
+        for start, end in zip(starts, ends)
     }
 
-def build_sessions(packets):
-    """Group packets into sessions based on 5-tuple."""
-    sessions = defaultdict(list)
-    
-    for pkt in packets:
-        info = extract_packet_info(pkt)
-        
-        # Create session key (bidirectional)
-        key1 = (info["src_ip"], info["dst_ip"], info["src_port"], info["dst_port"])
-        key2 = (info["dst_ip"], info["src_ip"], info["dst_port"], info["src_port"])
-        
-        # Use consistent key ordering
-        session_key = tuple(sorted([key1, key2])[0])
-        sessions[session_key].append(info)
-    
-    return sessions
-
-def calculate_unique_destinations(all_sessions, current_session_key, window_minutes=10):
+def calculate_unique_destinations(destination_index, src_ip, latest_time, window_minutes=10):
     """Calculate unique destination count in sliding time window."""
-    current_packets = all_sessions[current_session_key]
-    if not current_packets:
-        return 0
-    
-    latest_time = max(p["timestamp"] for p in current_packets)
+    timestamps, destinations = destination_index[src_ip]
     window_start = latest_time - (window_minutes * 60)
     
-    src_ip = current_session_key[0]
-    destinations = set()
-    
-    for session_key, packets in all_sessions.items():
-        if session_key[0] == src_ip:  # Same source IP
-            for pkt in packets:
-                if window_start <= pkt["timestamp"] <= latest_time:
-                    destinations.add(session_key[1])  # Add destination IP
+    start = np.searchsorted(timestamps, window_start, side="left")
+    end = np.searchsorted(timestamps, latest_time, side="right")
     
-    return len(destinations)
+    return len(np.unique(destinations[start:end]))
 
-def extract_features(sessions):
+def format_timestamps(timestamps):
+    """Format epoch seconds as local ISO 8601 strings, vectorized.
+    
+    Matches datetime.fromtimestamp(t).isoformat(): microseconds are rounded
+    half-to-even and omitted when zero.
+    """
+    timestamps = np.asarray(timestamps, dtype=np.float64)
+    seconds = np.floor(timestamps)
+    micros = np.round((timestamps - seconds) * 1e6)
+    carry = micros >= 1_000_000
+    seconds = (seconds + carry).astype(np.int64)
+    micros = np.where(carry, micros - 1_000_000, micros).astype(np.int64)
+    
+    # Local UTC offset looked up once per distinct minute
+    # (DST transitions fall on minute boundaries)
+    minutes, inverse = np.unique(seconds // 60, return_inverse=True)
+    offsets = np.array([time.localtime(m * 60).tm_gmtoff for m in minutes.tolist()], dtype=np.int64)
+    local = (seconds + offsets[inverse]).astype("datetime64[s]") + micros.astype("timedelta64[us]")
+    
+    return np.where(
+        micros == 0,
+        np.datetime_as_string(local, unit="s"),
+        np.datetime_as_string(local, unit="us")
+    ).tolist()
+
+def extract_features(packets):
     """Extract numeric features from sessions."""
-    features_list = []
-    
-    for session_key, packets in sessions.items():
-        if not packets:
-            continue
-        
-        timestamps = [p["timestamp"] for p in packets]
-        duration = max(timestamps) - min(timestamps)
-        total_bytes = sum(p["bytes"] for p in packets)
-        packet_count = len(packets)
-        packets_per_second = packet_count / duration if duration > 0 else packet_count
-        
-        unique_dest_count = calculate_unique_destinations(sessions, session_key)
-        
-        features = {
-            "src_ip": session_key[0],
-            "dst_ip": session_key[1],
-            "src_port": session_key[2],
-            "dst_port": session_key[3],
-            "duration": round(duration, 3),
-            "total_bytes": total_bytes,
-            "packet_count": packet_count,
-            "packets_per_second": round(packets_per_second, 3),
-            "unique_destination_count": unique_dest_count,
-            "first_seen": datetime.fromtimestamp(min(timestamps)).isoformat(),
-            "last_seen": datetime.fromtimestamp(max(timestamps)).isoformat()
-        }
-        
-        features_list.append(features)
-    
-    return features_list
+    sessions = packets.groupby(SESSION_KEY, sort=False).agg(
+        first_time=("timestamp", "min"),
+        latest_time=("timestamp", "max"),
+        total_bytes=("bytes", "sum"),
+        packet_count=("bytes", "size")
+    ).reset_index()
+    
+    duration = sessions["latest_time"] - sessions["first_time"]
+    # Zero-duration sessions keep the integer packet count as their rate
+    packets_per_second = [
+        round(count / elapsed, 3) if elapsed > 0 else count
+        for count, elapsed in zip(sessions["packet_count"].tolist(), duration.tolist())
+    ]
+    
+    destination_index = build_destination_index(packets)
+    unique_dest_count = [
+        calculate_unique_destinations(destination_index, src_ip, latest_time)
+        for src_ip, latest_time in zip(sessions["src_ip"], sessions["latest_time"])
+    ]
+    
+    features = pd.DataFrame({
+        "src_ip": sessions["src_ip"],
+        "dst_ip": sessions["dst_ip"],
+        "src_port": sessions["src_port"],
+        "dst_port": sessions["dst_port"],
+        "duration": duration.round(3),
+        "total_bytes": sessions["total_bytes"],
+        "packet_count": sessions["packet_count"],
+        "packets_per_second": pd.Series(packets_per_second, dtype=object),
+        "unique_destination_count": unique_dest_count,
+        "first_seen": format_timestamps(sessions["first_time"]),
+        "last_seen": format_timestamps(sessions["latest_time"])
+    })
+    
+    return features.to_dict("records")
 
-def main(pcap_file, output_file):
+def main(pcap_file, output_file, directional=False):
     """Main extraction pipeline."""
     print(f"Processing {pcap_file}...")
     
-    # Convert PCAP to JSON
-    packets = run_tshark(pcap_file)
+    # Read packets straight from the capture file
+    packets = read_pcap(pcap_file)
     
-    if not packets:
+    if packets.empty:
         print("No packets extracted.", file=sys.stderr)
         return
     
     print(f"Extracted {len(packets)} packets")
     
     # Build sessions
-    sessions = build_sessions(packets)
-    print(f"Built {len(sessions)} sessions")
+    packets = build_sessions(packets, directional)
     
     # Extract features
-    features = extract_features(sessions)
+    features = extract_features(packets)
     print(f"Extracted features for {len(features)} sessions")
     
     # Save to JSON
-    with open(output_file, 'w') as f:
-        json.dump(features, f, indent=2)
+    with open(output_file, 'wb') as f:
+        f.write(orjson.dumps(features, option=orjson.OPT_INDENT_2))
     
     print(f"Saved to {output_file}")
 
 if __name__ == "__main__":
-    if len(sys.argv) != 3:
-        print("Usage: python feature_extraction.py <input.pcap> <output.json>")
+    args = [arg for arg in sys.argv[1:] if arg != "--directional"]
+    directional = len(args) != len(sys.argv) - 1
+    
+    if len(args) != 2:
+        print("Usage: python feature_extraction.py <input.pcap> <output.json> [--directional]")
+        print("  --directional: key sessions by packet direction instead of merging both directions")
         sys.exit(1)
     
-    main(sys.argv[1], sys.argv[2])
\ No newline at end of file
+    main(args[0], args[1], directional)
\ No newline at end of file
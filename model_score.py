@@ -4,12 +4,21 @@ model_score.py
 Score sessions using trained IsolationForest model.
 """
 
-import json
 import sys
-import pickle
+import joblib
 import numpy as np
+import orjson
 from pathlib import Path
 
+# Numeric session features used by the model, in column order
+FEATURE_KEYS = [
+    "duration",
+    "total_bytes",
+    "packet_count",
+    "packets_per_second",
+    "unique_destination_count",
+]
+
 def load_model(model_file="model.pkl"):
     """Load trained model and scaler."""
     if not Path(model_file).exists():
@@ -17,54 +26,60 @@ def load_model(model_file="model.pkl"):
         print("Please train a model first using model_train.py", file=sys.stderr)
         sys.exit(1)
     
-    with open(model_file, 'rb') as f:
-        data = pickle.load(f)
+    # Memory-map numpy arrays instead of copying them onto the heap
+    data = joblib.load(model_file, mmap_mode='r')
     
     return data['model'], data['scaler']
 
 def load_sessions(json_file):
     """Load session features from JSON."""
-    with open(json_file, 'r') as f:
-        return json.load(f)
+    with open(json_file, 'rb') as f:
+        return orjson.loads(f.read())
 
 def prepare_features(sessions):
-    """Convert sessions to numeric feature matrix."""
-    features = []
+    """Convert sessions to numeric feature matrix (float32, one column per feature)."""
+    columns = {key: [] for key in FEATURE_KEYS}
     
     for session in sessions:
-        feature_vector = [
-            session.get("duration", 0),
-            session.get("total_bytes", 0),
-            session.get("packet_count", 0),
-            session.get("packets_per_second", 0),
-            session.get("unique_destination_count", 0)
-        ]
-        features.append(feature_vector)
-    
-    return np.array(features)
+        for key in FEATURE_KEYS:
+            columns[key].append(session.get(key, 0))
+    
+    return np.array([columns[key] for key in FEATURE_KEYS], dtype=np.float32).T
 
 def score_sessions(sessions, model, scaler):
     """Score sessions and add anomaly scores."""
     features = prepare_features(sessions)
-    features_scaled = scaler.transform(features)
+    
+    # Scale in place on one contiguous float32 buffer
+    # (same as scaler.transform, without its validation and extra copy)
+    features_scaled = np.ascontiguousarray(features, dtype=np.float32)
+    np.subtract(features_scaled, scaler.mean_.astype(np.float32), out=features_scaled)
+    np.divide(features_scaled, scaler.scale_.astype(np.float32), out=features_scaled)
     
     # Get anomaly scores (negative scores are more anomalous)
     scores = model.score_samples(features_scaled)
     
     # Normalize scores to 0-1 range (higher = more anomalous)
     # IsolationForest returns negative scores, we invert and normalize
+    # (computed in place on the scores buffer, no temporaries)
     min_score = scores.min()
-    max_score = scores.max()
+    score_range = scores.max() - min_score
     
-    if max_score != min_score:
-        normalized_scores = 1 - (scores - min_score) / (max_score - min_score)
+    if score_range:
+        normalized_scores = scores
+        np.subtract(normalized_scores, min_score, out=normalized_scores)
+        np.divide(normalized_scores, score_range, out=normalized_scores)
+        np.subtract(1.0, normalized_scores, out=normalized_scores)
     else:
         normalized_scores = np.zeros_like(scores)
     
-    # Add scores to sessions
-    for i, session in enumerate(sessions):
-        session['anomaly_score'] = float(normalized_scores[i])
-        session['is_anomaly'] = int(model.predict(features_scaled[i].reshape(1, -1))[0] == -1)
+    # Predict all sessions in one batched call (-1 = anomaly)
+    is_anomaly = (model.predict(features_scaled) == -1).astype(int)
+    
+    # Add scores to sessions (tolist converts to Python floats/ints in one pass)
+    for session, score, anomaly in zip(sessions, normalized_scores.tolist(), is_anomaly.tolist()):
+        session['anomaly_score'] = score
+        session['is_anomaly'] = anomaly
     
     return sessions
 
@@ -82,8 +97,9 @@ def main(json_file, output_file, model_file="model.pkl"):
     scored_sessions = score_sessions(sessions, model, scaler)
     
     # Save results
-    with open(output_file, 'w') as f:
-        json.dump(scored_sessions, f, indent=2)
+    with open(output_file, 'wb') as f:
+        f.write(orjson.dumps(scored_sessions,
+                             option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY))
     
     # Summary
     anomalies = [s for s in scored_sessions if s['is_anomaly']]
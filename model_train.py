@@ -4,94 +4,143 @@ model_train.py
 Train IsolationForest model on extracted session features.
 """
 
-import json
+import os
 import sys
-import pickle
+import ijson
+import joblib
 import numpy as np
 from sklearn.ensemble import IsolationForest
 from sklearn.preprocessing import StandardScaler
 from pathlib import Path
 
-def load_sessions(json_file):
-    """Load session features from JSON."""
-    with open(json_file, 'r') as f:
-        return json.load(f)
+# Numeric session features used by the model, in column order
+FEATURE_KEYS = [
+    "duration",
+    "total_bytes",
+    "packet_count",
+    "packets_per_second",
+    "unique_destination_count",
+]
+
+# Parallel jobs for IsolationForest. Defaults to half the cores so training
+# does not oversubscribe the CPU while ollama is running inference.
+N_JOBS = int(os.getenv("N_JOBS", max(1, (os.cpu_count() or 2) // 2)))
+
+# Sessions parsed per chunk, and rows kept (reservoir sample) to fit the forest on
+CHUNK_SIZE = 10000
+SAMPLE_SIZE = 4096
+
+def iter_session_chunks(json_file, chunk_size=CHUNK_SIZE):
+    """Stream session features from a JSON array in lists of up to chunk_size."""
+    with open(json_file, 'rb') as f:
+        chunk = []
+        for session in ijson.items(f, 'item', use_float=True):
+            chunk.append(session)
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
 
 def prepare_features(sessions):
-    """Convert sessions to numeric feature matrix."""
-    features = []
+    """Convert sessions to numeric feature matrix (float32, one column per feature)."""
+    columns = {key: [] for key in FEATURE_KEYS}
     
     for session in sessions:
-        # Extract numeric features only
-        feature_vector = [
-            session.get("duration", 0),
-            session.get("total_bytes", 0),
-            session.get("packet_count", 0),
-            session.get("packets_per_second", 0),
-            session.get("unique_destination_count", 0)
-        ]
-        features.append(feature_vector)
-    
-    return np.array(features)
+        for key in FEATURE_KEYS:
+            columns[key].append(session.get(key, 0))
+    
+    return np.array([columns[key] for key in FEATURE_KEYS], dtype=np.float32).T
 
-def train_model(features, contamination=0.1):
+def fit_scaler(json_file, sample_size=SAMPLE_SIZE, seed=42):
+    """Fit the scaler chunk by chunk and reservoir-sample rows for training.
+    
+    Returns (scaler, sample, n_sessions); only one chunk and the sample are
+    held in memory at a time.
+    """
+    scaler = StandardScaler()
+    rng = np.random.default_rng(seed)
+    sample = np.empty((sample_size, len(FEATURE_KEYS)), dtype=np.float32)
+    seen = 0
+    
+    for chunk in iter_session_chunks(json_file):
+        features = prepare_features(chunk)
+        scaler.partial_fit(features)
+        
+        # Reservoir sampling (Algorithm R), vectorized over the chunk:
+        # row i fills slot i while the reservoir is filling, afterwards it
+        # replaces a random slot j in [0, i] if j < sample_size
+        index = np.arange(seen, seen + len(features))
+        filling = index < sample_size
+        sample[index[filling]] = features[filling]
+        slots = rng.integers(0, index[~filling] + 1)
+        keep = slots < sample_size
+        sample[slots[keep]] = features[~filling][keep]
+        
+        seen += len(features)
+    
+    return scaler, sample[:min(seen, sample_size)], seen
+
+def train_model(features, scaler, contamination=0.1, n_jobs=N_JOBS):
     """Train IsolationForest model."""
     print(f"Training on {len(features)} samples...")
     
     # Normalize features
-    scaler = StandardScaler()
-    features_scaled = scaler.fit_transform(features)
+    features_scaled = scaler.transform(features)
     
     # Train Isolation Forest
     model = IsolationForest(
         contamination=contamination,
         random_state=42,
         n_estimators=100,
-        max_samples='auto',
-        n_jobs=-1
+        max_samples=min(256, len(features)),
+        n_jobs=n_jobs
     )
     
     model.fit(features_scaled)
     
     print("Model trained successfully")
     
-    return model, scaler
+    return model
 
 def save_model(model, scaler, model_file="model.pkl"):
-    """Save trained model and scaler."""
-    with open(model_file, 'wb') as f:
-        pickle.dump({'model': model, 'scaler': scaler}, f)
+    """Save trained model and scaler.
+    
+    Stored uncompressed so model_score.py can memory-map the numpy arrays.
+    """
+    joblib.dump({'model': model, 'scaler': scaler}, model_file)
     
     print(f"Model saved to {model_file}")
 
 def main(json_file, model_file="model.pkl", contamination=0.1):
     """Main training pipeline."""
     print(f"Loading sessions from {json_file}...")
-    sessions = load_sessions(json_file)
     
-    if len(sessions) < 10:
+    # First pass: fit scaler and sample training rows
+    scaler, sample, n_sessions = fit_scaler(json_file)
+    
+    if n_sessions < 10:
         print("Error: Need at least 10 sessions for training", file=sys.stderr)
         sys.exit(1)
     
-    print(f"Loaded {len(sessions)} sessions")
-    
-    # Prepare feature matrix
-    features = prepare_features(sessions)
-    print(f"Feature matrix shape: {features.shape}")
+    print(f"Loaded {n_sessions} sessions")
+    print(f"Training sample shape: {sample.shape}")
     
     # Train model
-    model, scaler = train_model(features, contamination)
+    model = train_model(sample, scaler, contamination)
     
     # Save model
     save_model(model, scaler, model_file)
     
-    # Show training summary
-    predictions = model.predict(scaler.transform(features))
-    n_anomalies = np.sum(predictions == -1)
+    # Show training summary (second pass over all sessions)
+    n_anomalies = 0
+    for chunk in iter_session_chunks(json_file):
+        predictions = model.predict(scaler.transform(prepare_features(chunk)))
+        n_anomalies += int(np.sum(predictions == -1))
     print(f"\nTraining Summary:")
-    print(f"  Total samples: {len(predictions)}")
+    print(f"  Total samples: {n_sessions}")
     print(f"  Anomalies detected: {n_anomalies}")
-    print(f"  Anomaly rate: {n_anomalies/len(predictions)*100:.2f}%")
+    print(f"  Anomaly rate: {n_anomalies/n_sessions*100:.2f}%")
 
 if __name__ == "__main__":
     if len(sys.argv) < 2:
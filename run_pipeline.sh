@@ -46,13 +46,18 @@ check_dependencies() {
         missing=1
     fi
     
-    if ! command -v tshark &> /dev/null; then
-        error "tshark not found. Please install: sudo apt-get install tshark"
+    if ! python3 -c "import dpkt" 2>/dev/null; then
+        error "dpkt not found. Please install: pip install dpkt"
         missing=1
     fi
     
     if ! command -v ollama &> /dev/null; then
-        warn "ollama not found. Install from: https://ollama.ai"
+        warn "ollama not found locally. Install from: https://ollama.ai"
+        warn "LLM analysis will use the server at ${OLLAMA_HOST:-http://localhost:11434}"
+    fi
+    
+    if ! python3 -c "import ollama" 2>/dev/null; then
+        warn "ollama Python client not found. Please install: pip install ollama"
         warn "LLM analysis will be skipped"
     fi
     
@@ -66,6 +71,21 @@ check_dependencies() {
         missing=1
     fi
     
+    if ! python3 -c "import pandas" 2>/dev/null; then
+        error "pandas not found. Please install: pip install pandas"
+        missing=1
+    fi
+    
+    if ! python3 -c "import ijson" 2>/dev/null; then
+        error "ijson not found. Please install: pip install ijson"
+        missing=1
+    fi
+    
+    if ! python3 -c "import orjson" 2>/dev/null; then
+        error "orjson not found. Please install: pip install orjson"
+        missing=1
+    fi
+    
     if [ $missing -eq 1 ]; then
         error "Missing dependencies. Please install them first."
         exit 1
@@ -126,7 +146,7 @@ process_pcap() {
     local basename=$(basename "$pcap_file" .pcap)
     local sessions_file="$DATA_DIR/${basename}_sessions.json"
     local scored_file="$DATA_DIR/${basename}_scored.json"
-    local analysis_file="$LOGS_DIR/${basename}_analysis.json"
+    local analysis_file="$LOGS_DIR/${basename}_analysis.jsonl"
     
     log "Processing $pcap_file..."
     
@@ -148,12 +168,12 @@ process_pcap() {
     log "  Scoring sessions..."
     python3 model_score.py "$sessions_file" "$scored_file" "$MODEL_FILE"
     
-    # Step 3: Analyze with Ollama (if available)
-    if command -v ollama &> /dev/null; then
+    # Step 3: Analyze with Ollama (if the client is available; OLLAMA_HOST may be remote)
+    if python3 -c "import ollama" 2>/dev/null; then
         log "  Analyzing anomalies with LLM..."
         python3 analyze_with_ollama.py "$scored_file" "$analysis_file" "$ANOMALY_THRESHOLD" "$OLLAMA_MODEL"
     else
-        warn "  Skipping LLM analysis (Ollama not available)"
+        warn "  Skipping LLM analysis (ollama Python client not available)"
     fi
     
     log "  Processing complete: $basename"